@@ -46,18 +46,5 @@ class PTS_DTS_flags(IntFlag):
     DTS = 0b01
     PTS = 0b10
 
-def __patch_enums():
-    _ptsdts_new = PTS_DTS_flags.__new__
-    def _new_ptsdts_flag(cls, value: int) -> PTS_DTS_flags:
-        assert value & 0b11 != 0b01, "Illegal PTS_DTS_Flag"
-        return _ptsdts_new(cls, value)
-    PTS_DTS_flags.__new__ = _new_ptsdts_flag
-
-    _afc_new = AdaptationFieldControl.__new__
-    def _new_afc(cls, value: int) -> AdaptationFieldControl:
-        assert value > 0, "Illegal adaptation_field_control"
-        return _afc_new(cls, value)
-    AdaptationFieldControl.__new__ = _new_afc
-__patch_enums()
 
 ####
@@ -18,8 +18,13 @@ You should have received a copy of the GNU General Public License
 along with TSar.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from typing import Optional, Any, Callable
+from typing import Optional, Any, Callable, Generator
 from functools import wraps
+from contextlib import contextmanager, suppress
+from pathlib import Path
+import mmap
+import stat
+import os
 
 from consts import *
 
@@ -89,3 +94,52 @@ class OptionalBlock:
         raise NotImplementedError
 
 ####
+
+@contextmanager
+def mapped_file(fp: Path) -> Generator[memoryview, None, None]:
+    """
+    Map a whole file read-only and provide a memoryview over it.
+    Raises ValueError for pipes and devices, which cannot be mapped.
+    """
+    fd = os.open(fp, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        st = os.fstat(fd)
+        #Pipes and devices report a zero size, they must not pass for empty files.
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError(f"Cannot map '{fp}', not a regular file.")
+        #Only a hint, some filesystems reject it.
+        if hasattr(os, 'posix_fadvise'):
+            with suppress(OSError):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        #mmap refuses to map empty files
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ) if st.st_size else None
+    finally:
+        os.close(fd)
+    if mm is None:
+        yield memoryview(b'')
+        return
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    mv = memoryview(mm)
+    try:
+        yield mv
+    finally:
+        mv.release()
+        #Packets still referencing the mapping keep it alive until collected.
+        with suppress(BufferError):
+            mm.close()
+
+def gen_windows(mv: memoryview, start: int, stop: int, step: int, window: int = 4 << 20) -> Generator[range, None, None]:
+    """
+    Split range(start, stop, step) over a mapping in windows, asking the kernel
+    to read the next window in the background while the current one is parsed.
+    """
+    window -= window % step
+    prefetch = isinstance(mv.obj, mmap.mmap) and hasattr(mmap, 'MADV_WILLNEED')
+    for offset in range(start, stop, window):
+        end = offset + window
+        if prefetch and end < len(mv):
+            #madvise needs a page aligned start
+            aligned = end - end % mmap.PAGESIZE
+            mv.obj.madvise(mmap.MADV_WILLNEED, aligned, min(window + end - aligned, len(mv) - aligned))
+        yield range(offset, min(end, stop), step)
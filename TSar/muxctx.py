@@ -24,10 +24,13 @@ from contextlib import nullcontext
 from dataclasses import dataclass
 import struct
 
-from consts import AdaptationFieldControl
-from streams import TransportStream, TSPacket
+from generics import mapped_file
+from streams import TransportStream
 from pespacket import PESPacket
 
+# 'P', TP count, PES size (24 bits), DTS (33 bits) and PTS (39 bits) sharing a byte.
+_PA_RECORD = struct.Struct(">BHHBIBI")
+
 @dataclass
 class PacketAttribute:
     tp_count: int
@@ -37,20 +40,17 @@ class PacketAttribute:
     
     @classmethod
     def from_pa(cls, bstr: bytes) -> 'PacketAttribute':
-        assert bstr[0] == 80 and len(bstr) >= 15
-        tp_cnt, pck_size = struct.unpack(">HI", bstr[1:7])
-        dts, pts = cls._decode_timestamps(bstr[6:15])
-        return cls(tp_cnt, pck_size >> 8, pts, dts)
-        
-    @staticmethod
-    def _decode_timestamps(tc_string) -> tuple[int, int]:
-        dts = (struct.unpack(">I", tc_string[:4])[0]) << 1
-        dts += (tc_string[4] >> 7)
+        assert len(bstr) >= 15
+        return cls.from_record(*_PA_RECORD.unpack_from(bstr))
 
+    @classmethod
+    def from_record(cls, sig: int, tp_cnt: int, size_msb: int, size_lsb: int,
+                    dts_msb: int, xts_mid: int, pts_lsb: int) -> 'PacketAttribute':
+        assert sig == 80
+        dts = (dts_msb << 1) | (xts_mid >> 7)
         # PTS has 39 bits, whom 6 are unused, so we assume 33 bits.
-        pts = (tc_string[4] & 0x7F) << 32
-        pts += struct.unpack(">I", tc_string[5:])[0]
-        return dts, (pts >> 6)
+        pts = ((xts_mid & 0x7F) << 32) | pts_lsb
+        return cls(tp_cnt, (size_msb << 8) | size_lsb, pts >> 6, dts)
 ####
 
 #%%
@@ -68,19 +68,19 @@ class PAF:
         """
         Yields packet attributes from the PA collection in the file.
         """
-        with open(self._fp, 'rb') as f:
-            buffer = f.read(0x7FFF)
-            
-            self._pid, header = __class__._read_header(buffer)
+        if self._fp.is_file():
+            source = mapped_file(self._fp)
+        else:
+            #Pipes and devices cannot be mapped, PA files are small enough to be read whole.
+            source = nullcontext(memoryview(self._fp.read_bytes()))
+        with source as mv:
+            self._pid, header = __class__._read_header(mv)
             assert 0 < self._pid < 0x1FFF, "Bad file header."
-            buffer = buffer[2+1+len(header):]
-            
-            while buffer:
-                yield PacketAttribute.from_pa(buffer[:15])
-                buffer = buffer[15:]
-                if len(buffer) < 15:
-                    buffer += f.read(0x7FFF)
-                    assert len(buffer) >= 15 or len(buffer) == 0
+
+            off = 2+1+len(header)
+            assert (len(mv) - off) % _PA_RECORD.size == 0, "Truncated packet attribute."
+            for record in _PA_RECORD.iter_unpack(mv[off:]):
+                yield PacketAttribute.from_record(*record)
         ####
     
     @staticmethod
@@ -109,38 +109,46 @@ class Demux:
         pafg = PAFGenerator(folder)
 
         # PMT, SIT, PMP, PCR, null packet
-        excluded_pids = [0x0000, 0x001F, 0x0100, 0x1001, 0x1FFF]
-        if self.excluded_pids:
-            excluded_pids += self.excluded_pids
+        excluded_pids = bytearray(0x2000)
+        for pid in (0x0000, 0x001F, 0x0100, 0x1001, 0x1FFF, *(self.excluded_pids or ())):
+            assert 0 <= pid <= 0x1FFF
+            excluded_pids[pid] = 1
         pck_buffer = dict()
+        pck_count = dict()
         
         if getattr(pbar, 'update', None) is None:
             pbar.update = lambda *args, **kwargs: None
         with pbar:
-            for tp in self.ts:
-                if tp.PID in excluded_pids:
+            for pid, pusi, payload in self.ts.gen_payloads():
+                if excluded_pids[pid]:
                     continue
-                assert tp.adaptation_field_control & AdaptationFieldControl.PAYLOAD
-                pesp, cnt = __class__._proc_transport_packet(tp, pck_buffer)
+                assert payload is not None
+                pes_buf, cnt = __class__._proc_transport_packet(pid, pusi, payload, pck_buffer, pck_count)
     
                 if cnt > 0:
-                    pafg.add_packet(tp.PID, pesp, cnt)
+                    pafg.add_packet(pid, PESPacket(pes_buf), cnt)
                 pbar.update()
-        for pid, lpck in pck_buffer.items():
-            pesp = PESPacket(b''.join(map(lambda pib: pib.payload, lpck)))
-            pafg.add_packet(pid, pesp, len(lpck))
+        #Only PIDs with a PES in progress hold an accumulator.
+        while pck_buffer:
+            pid, pes_buf = pck_buffer.popitem()
+            pafg.add_packet(pid, PESPacket(pes_buf), pck_count.pop(pid))
+        pafg.flush()
     ####
 
     @staticmethod
-    def _proc_transport_packet(tp: TSPacket, buffer: dict[int, list[TSPacket]]) -> Optional[tuple[PESPacket, int]]:
+    def _proc_transport_packet(pid: int, pusi: bool, payload: bytes,
+                               buffer: dict[int, bytearray], count: dict[int, int]) -> tuple[Optional[bytearray], int]:
         ret = None, 0
-        if tp.payload_unit_start_indicator and len(buffer.get(tp.PID, [])) > 0:
-            tp_grp = buffer.pop(tp.PID)
-            pesp = PESPacket(b''.join(map(lambda pib: pib.payload, tp_grp)))
-            ret = (pesp, len(tp_grp))
-        if buffer.get(tp.PID, None) is None:
-            buffer[tp.PID] = []
-        buffer[tp.PID].append(tp)
+        pes_buf = buffer.get(pid)
+        if pes_buf is not None and pusi:
+            #The completed PES is returned, a new accumulator is started.
+            ret = (pes_buf, count[pid])
+            pes_buf = None
+        if pes_buf is None:
+            pes_buf = buffer[pid] = bytearray()
+            count[pid] = 0
+        pes_buf += payload
+        count[pid] += 1
         return ret
 ####
 
@@ -150,19 +158,24 @@ class PAFGenerator:
     def __init__(self, folder: [Path | str]) -> None:
         self._folder = Path(folder)
         assert self._folder.exists()
-        self._pids = set()
+        #PAF content indexed by PID, written out by flush().
+        self._paf: list[Optional[bytearray]] = [None] * 0x2000
 
     def add_packet(self, pid: int, packet: PESPacket, cnt: int) -> None:
         assert 0 <= pid <= 0x1FFF
 
-        if pid not in self._pids:
-            sequence = bytes([pid >> 8, pid & 0xFF])
-            self._pids.add(pid)
-            with open(self._folder.joinpath(f"{pid:04X}" + '.paf'), 'wb') as f:
-                f.write(sequence + b'\x00')
+        if self._paf[pid] is None:
+            #PID and empty header extension
+            self._paf[pid] = bytearray((pid >> 8, pid & 0xFF, 0))
 
         self.append_index_file(pid, packet, cnt)
 
+    def flush(self) -> None:
+        for pid, paf in enumerate(self._paf):
+            if paf is None:
+                continue
+            self._folder.joinpath(f"{pid:04X}" + '.paf').write_bytes(paf)
+
     def append_index_file(self, pid: int, packet: PESPacket, cnt: int) -> None:
         assert packet.pts is not None
         
@@ -170,23 +183,15 @@ class PAFGenerator:
             dts = packet.pts
         else:
             dts = packet.dts
-        temporal = __class__.encode_pts_dts(packet.pts, dts)
-        assert any(temporal), "Zero PTS and DTS is illegal."
-
-        with open(self._folder.joinpath(f"{pid:04X}" + '.paf'), 'ab') as f:
-            spatial = struct.pack(">H", cnt) + struct.pack(">I", len(packet))[1:]
-            f.write((b'P' + spatial + temporal))
-
-    @staticmethod
-    def encode_pts_dts(pts: int, dts: int) -> bytes:
-        payload = bytearray(b'\x00'*9)
-        # encode DTS MSBs.LSB
-        payload[:4] = struct.pack(">I", (dts >> 1) & ((1 << 32) - 1))
-
-        # encode PTS as 40 bits, easier than the misaligned 33 bits.
-        payload[4:9] = struct.pack(">Q", (pts << 6) & ((1 << 39) - 1))[3:]
-        payload[4] |= ((dts & 0x1) << 7)
-        return payload
+        pts = packet.pts & ((1 << 33) - 1)
+        dts &= (1 << 33) - 1
+        assert pts or dts, "Zero PTS and DTS is illegal."
+
+        size = len(packet)
+        #DTS MSBs on 32 bits, DTS LSB, then PTS on 39 bits (easier than the misaligned 33 bits).
+        record = _PA_RECORD.pack(80, cnt, size >> 8, size & 0xFF,
+                                 dts >> 1, ((dts & 0x1) << 7) | (pts >> 26), (pts << 6) & ((1 << 32) - 1))
+        self._paf[pid] += record
 ####
 
 #%%
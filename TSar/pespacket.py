@@ -23,15 +23,45 @@ from generics import *
 from consts import *
 
 class PESPacket:
-    __slots__ = 'data'
+    #pts_dts_flags, pts and dts are decoded once, None if absent.
+    __slots__ = ('data', 'pts_dts_flags', 'pts', 'dts', '_ext_offset', '_stuffing_offset')
     def __init__(self, data: bytes) -> None:
         assert len(data) >= 6
         self.data = data
         assert self.packet_start_code_prefix == 0x000001
         #Video streams do not have to report a valid pes_packet_length
         if self.stream_id & 0xF0 != 0xE0:
-            assert len(self.data) >= self.size()
-            self.data = self.data[:self.size()]
+            size = self.size()
+            assert len(data) >= size
+            if len(data) != size:
+                #data may be a memoryview, accessors returning bytes copy out of it.
+                self.data = memoryview(data)[:size]
+        self._layout()
+
+    def _layout(self) -> None:
+        #Offsets are relative to the optional fields, following pes_header_data_length.
+        self.pts_dts_flags = self.pts = self.dts = None
+        self._ext_offset = self._stuffing_offset = 0
+        if self.stream_id in STREAM_IDS_NO_PES_PACKET_HEADER:
+            return
+
+        flags = self.data[7]
+        pts_dts = flags >> 6
+        assert pts_dts != 0b01, "Illegal PTS_DTS_Flag"
+        self.pts_dts_flags = PTS_DTS_flags(pts_dts)
+        if pts_dts & 0b10: #PTS
+            assert PTS_DTS_flags.PTS & (self.data[9] >> 4)
+            self.pts = __class__._parse_xts(self.data[9:14])
+            if pts_dts & 0b01: #DTS
+                self.dts = __class__._parse_xts(self.data[14:19])
+
+        offset = 5*(pts_dts >> 1) + 5*(pts_dts & 0x01)
+        offset += 6*((flags >> 5) & 0x01) + 3*((flags >> 4) & 0x01)
+        offset += ((flags >> 3) & 0x01) + ((flags >> 2) & 0x01) + 2*((flags >> 1) & 0x01)
+        self._ext_offset = offset
+        if flags & 0x01:
+            offset += len(self.pes_extension)
+        self._stuffing_offset = offset
 
     def __len__(self) -> int:
         return len(self.data)
@@ -74,10 +104,6 @@ class PESPacket:
     def original_or_copy(self) -> bool:
         return (self.data[6] & 0x01) > 0
 
-    @standard_stream_property
-    def pts_dts_flags(self) -> int:
-        return PTS_DTS_flags((self.data[7] >> 6) & 0b11)
-
     @standard_stream_property
     def escr_flag(self) -> bool:
         return (self.data[7] & 0x20) > 0
@@ -108,52 +134,9 @@ class PESPacket:
 
     @staticmethod
     def _parse_xts(data: bytes) -> int:
-        xts = (data[0] & 0x0E) << 30
-        xts |= (data[1] & 0xFF) << 22
-        xts |= (data[2] & 0xFE) << 14
-        xts |= (data[3] & 0xFF) << 7
-        return xts | ((data[4] & 0xFE) >> 1)
-
-    @standard_stream_property
-    @exist_if(pts_dts_flags, lambda pdf: PTS_DTS_flags.PTS in pdf)
-    def pts(self) -> int:
-        assert PTS_DTS_flags.PTS & (self.data[9] >> 4)
-        return __class__._parse_xts(self.data[9:14])
-
-    @standard_stream_property
-    @exist_if(pts_dts_flags, lambda pdf: PTS_DTS_flags.DTS in pdf)
-    def dts(self) -> int:
-        assert PTS_DTS_flags.PTS & (self.data[9] >> 4) > 0
-        return __class__._parse_xts(self.data[14:19])
-
-    @standard_stream_offset
-    def _pts_dts_offset(self) -> int:
-        return sum([5 for flag in PTS_DTS_flags if flag in self.pts_dts_flags])
-
-    @standard_stream_offset
-    def _escr_offset(self) -> int:
-        return 6*self.escr_flag + self._pts_dts_offset()
-
-    @standard_stream_offset
-    def _es_rate_offset(self) -> int:
-        return 3*self.escr_flag + self._escr_offset()
-
-    @standard_stream_offset
-    def _dsm_trick_mode_offset(self) -> int:
-        return 1*self.dsm_trick_mode_flag + self._es_rate_offset()
-
-    @standard_stream_offset
-    def _additional_copy_info_offset(self) -> int:
-        return 1*self.additional_copy_info_flag + self._dsm_trick_mode_offset()
-
-    @standard_stream_offset
-    def _previous_pes_packet_crc_offset(self) -> int:
-        return 2*self.pes_crc_flag + self._additional_copy_info_offset()
-
-    @standard_stream_offset
-    def _pes_extension_offset(self) -> int:
-        pes_ext = self.pes_extension
-        return (0 if pes_ext is None else len(pes_ext)) + self._previous_pes_packet_crc_offset()
+        #'001x' xts[32..30] 1 xts[29..15] 1 xts[14..0] 1
+        xts = int.from_bytes(data[:5], 'big')
+        return ((xts >> 3) & (0x7 << 30)) | ((xts >> 2) & (0x7FFF << 15)) | ((xts >> 1) & 0x7FFF)
 
     @standard_stream_property
     @exist_if(escr_flag)
@@ -177,8 +160,8 @@ class PESPacket:
 
     @standard_stream_property
     @exist_if(pes_extension_flag)
-    def pes_extension(self) -> int:
-        offset = self._previous_pes_packet_crc_offset()
+    def pes_extension(self) -> bytes:
+        offset = self._ext_offset
         length = 1
         length += 16 * bool(self.data[9+offset] & 0x80)
         if self.data[9+offset] & 0x40:
@@ -188,27 +171,28 @@ class PESPacket:
         if self.data[9+offset] & 0x01:
             assert self.data[9+offset+length] & 0x80
             length += 0x7F & self.data[9+offset+length]
-        return self.data[9+offset:9+offset+length]
+        return bytes(self.data[9+offset:9+offset+length])
 
     @standard_stream_property
     def stuffing(self) -> bytes:
-        start_idx = 9 + self._pes_extension_offset()
+        start_idx = 9 + self._stuffing_offset
         stop_idx = 9 + self.pes_header_data_length
         assert stop_idx - start_idx >= 0
-        assert all(map(lambda x: x == 0xFF, self.data[start_idx:stop_idx]))
-        return self.data[start_idx:stop_idx]
+        stuffing = bytes(self.data[start_idx:stop_idx])
+        assert all(map(lambda x: x == 0xFF, stuffing))
+        return stuffing
 
     @property
     def packet_data(self) -> bytes:
         offs = 6
         if self.pes_scrambling_control is not None: #Standard stream
-            offs += 3 + self._pes_extension_offset() + len(self.stuffing)
-        return self.data[offs:]
+            offs += 3 + self._stuffing_offset + len(self.stuffing)
+        return bytes(self.data[offs:])
 
     @property
     @exist_if(stream_id, lambda sid: sid == 0xBE)
     def padding(self) -> bytes:
-        padding = self.data[6:6+self.pes_packet_length]
+        padding = bytes(self.data[6:6+self.pes_packet_length])
         assert len(padding) == len(self.pes_packet_length)
         assert all(map(lambda x: x==0xFF, padding))
         return padding
@@ -19,12 +19,53 @@ along with TSar.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from abc import abstractproperty
-from typing import Generator, Type, Optional, Callable
+from typing import Generator, Type, Optional, Callable, Iterable
 from pathlib import Path
+from dataclasses import dataclass
+from array import array
+import sys
+import os
 
+from generics import mapped_file, gen_windows
 from tspacket import TSPacket, M2TSPacket
 from pespacket import PESPacket
 
+#Byte translation tables to extract header fields from whole columns at once.
+_PID_MSB = bytes(k & 0x1F for k in range(256))
+_PUSI = bytes((k >> 6) & 0x01 for k in range(256))
+_AFC = bytes((k >> 4) & 0b11 for k in range(256))
+_CC = bytes(k & 0x0F for k in range(256))
+_HAS_AF = bytes((k >> 5) & 0x01 for k in range(256))
+_NONZERO = bytes(k > 0 for k in range(256))
+_PCR_FLAG = bytes((k >> 4) & 0x01 for k in range(256))
+
+#Vectors per writev() call, POSIX guarantees at least 16 but Linux and macOS accept 1024.
+_IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 16
+
+def _writev(fd: int, buffers: list[bytes]) -> None:
+    written = os.writev(fd, buffers)
+    total = sum(map(len, buffers))
+    if written < total:
+        #Short write, finish with the remainder.
+        remainder = memoryview(b''.join(buffers))[written:]
+        while remainder:
+            remainder = remainder[os.write(fd, remainder):]
+
+def _column_mask(column: bytes, table: bytes) -> int:
+    #Each byte of the result is 0 or 1, one per packet, in a single integer.
+    return int.from_bytes(column.translate(table), 'big')
+
+@dataclass
+class PacketHeaders:
+    #One entry per transport packet, in stream order.
+    PID: array
+    payload_unit_start_indicator: bytes
+    adaptation_field_control: bytes
+    continuity_counter: bytes
+
+    def __len__(self) -> int:
+        return len(self.PID)
+
 #%%
 class AbstractTransportStream:
     def __init__(self, fpath: Path) -> None:
@@ -35,41 +76,185 @@ class AbstractTransportStream:
         raise NotImplementedError
 
     def gen_packets(self) -> Generator[TSPacket, None, None]:
-        file_hdl = open(self._fp, 'rb')
-        buffer = bytearray(file_hdl.read(0xFFFF))
-
-        size_pck = self.packet_class.size
+        """
+        Yields each transport packet of the stream. Packets own a copy of their
+        bytes, so they stay valid if the file is rewritten, e.g. by write_packets.
+        """
+        pck_cls = self.packet_class
+        size_pck = pck_cls.size
+
+        if not self._fp.is_file():
+            #Pipes and devices cannot be mapped.
+            yield from self._gen_read_packets()
+            return
+
+        with mapped_file(self._fp) as mv:
+            for offsets in gen_windows(mv, 0, len(mv) - size_pck + 1, size_pck):
+                for off in offsets:
+                    #The packet constructor copies its bytes out of the mapping.
+                    yield pck_cls(mv[off:off+size_pck])
+            assert len(mv) % size_pck == 0
+        return
 
-        while buffer:
-            assert len(buffer) >= size_pck
-            yield self.packet_class(buffer[:size_pck])
-            buffer = buffer[size_pck:]
-            if len(buffer) < size_pck:
-                new_data = file_hdl.read(0xFFFF)
-                if len(new_data) == 0:
+    def _gen_read_packets(self, n_packets: int = 1024) -> Generator[TSPacket, None, None]:
+        pck_cls = self.packet_class
+        size_pck = pck_cls.size
+
+        with open(self._fp, 'rb', buffering=0) as f:
+            #Packets copy their bytes, so the chunk is refilled in place.
+            chunk = memoryview(bytearray(size_pck * n_packets))
+            filled = 0
+            while True:
+                if filled:
+                    chunk[:filled] = tail
+                while filled < len(chunk) and (n_read := f.readinto(chunk[filled:])):
+                    filled += n_read
+                end = filled - filled % size_pck
+                for off in range(0, end, size_pck):
+                    yield pck_cls(chunk[off:off+size_pck])
+                tail, filled = bytes(chunk[end:filled]), filled - end
+                if end < len(chunk):
                     break
-                buffer += new_data
-        assert len(buffer) == 0
-        file_hdl.close()
+            assert filled == 0
+        return
+
+    def gen_payloads(self) -> Generator[tuple[int, bool, Optional[bytes]], None, None]:
+        """
+        Yields (PID, payload_unit_start_indicator, payload) of each transport packet,
+        parsed straight from the file mapping without instantiating packet objects.
+        The payload is None if the adaptation_field_control signals no payload.
+        Payloads are copies, so they stay valid if the file is rewritten.
+        """
+        size_pck = self.packet_class.size
+        hdr_len = self.packet_class.header_len
+
+        if not self._fp.is_file():
+            #Pipes and devices cannot be mapped, go through the packet reader.
+            for packet in self._gen_read_packets():
+                yield packet.PID, packet.payload_unit_start_indicator, packet.payload
+            return
+
+        with mapped_file(self._fp) as mv:
+            assert len(mv) % size_pck == 0
+            for offsets in gen_windows(mv, hdr_len, len(mv), size_pck):
+                for off in offsets:
+                    assert mv[off] == 0x47
+                    flags = mv[off+1]
+                    afc = mv[off+3] >> 4
+                    payload = None
+                    if afc & 0b01: #PAYLOAD
+                        start = off + 4
+                        if afc & 0b10: #ADAPTATION
+                            start += 1 + mv[start]
+                        payload = mv[start:off+188].tobytes()
+                    yield ((flags & 0x1F) << 8) | mv[off+2], (flags & 0x40) > 0, payload
         return
 
-    def _file_writer_packets(self, packets: list[TSPacket], mode: str) -> None:
+    def packet_headers(self) -> PacketHeaders:
+        """
+        Decodes the header fields of all transport packets at once, column by column.
+        Strided slices of the file mapping gather each header byte of every packet,
+        and translation tables then isolate the fields in C.
+        """
+        size_pck = self.packet_class.size
+        hdr_len = self.packet_class.header_len
+
+        if not self._fp.is_file():
+            #Pipes and devices cannot be mapped, gather the columns from the packet reader.
+            b1, b2, b3 = bytearray(), bytearray(), bytearray()
+            for packet in self._gen_read_packets():
+                b1.append(packet.data[1])
+                b2.append(packet.data[2])
+                b3.append(packet.data[3])
+            b1, b2, b3 = bytes(b1), bytes(b2), bytes(b3)
+        else:
+            with mapped_file(self._fp) as mv:
+                assert len(mv) % size_pck == 0
+                sync_bytes = mv[hdr_len::size_pck].tobytes()
+                assert sync_bytes.count(b'G') == len(sync_bytes)
+                b1 = mv[hdr_len+1::size_pck].tobytes()
+                b2 = mv[hdr_len+2::size_pck].tobytes()
+                b3 = mv[hdr_len+3::size_pck].tobytes()
+
+        pid = bytearray(2*len(b2))
+        pid[0::2] = b1.translate(_PID_MSB)
+        pid[1::2] = b2
+        pid = array('H', pid)
+        if sys.byteorder == 'little':
+            pid.byteswap()
+        return PacketHeaders(pid, b1.translate(_PUSI), b3.translate(_AFC), b3.translate(_CC))
+
+    def pcr_table(self, pid: int) -> tuple[array, array]:
+        """
+        Returns the indices of the packets of a PID that carry a PCR, and the PCR values.
+        The per-packet conditions are evaluated on header columns, as byte masks ANDed
+        together in big integers, so only packets with a PCR are visited in Python.
+        """
+        assert 0 <= pid <= 0x1FFF
+        size_pck = self.packet_class.size
+        hdr_len = self.packet_class.header_len
+
+        indices, pcrs = array('q'), array('q')
+        if not self._fp.is_file():
+            #Pipes and devices cannot be mapped, test each packet from the packet reader.
+            for idx, packet in enumerate(self._gen_read_packets()):
+                data = packet.data
+                if packet.PID == pid and data[3] & 0x20 and data[4] and data[5] & 0x10:
+                    pcr = int.from_bytes(data[6:12], 'big')
+                    indices.append(idx)
+                    pcrs.append((pcr >> 15)*300 + (pcr & 0x1FF))
+            return indices, pcrs
+
+        with mapped_file(self._fp) as mv:
+            assert len(mv) % size_pck == 0
+            b1, b2, b3, b4, b5 = (mv[hdr_len+k::size_pck].tobytes() for k in range(1, 6))
+            mask = _column_mask(b1, bytes((k & 0x1F) == (pid >> 8) for k in range(256)))
+            mask &= _column_mask(b2, bytes(k == (pid & 0xFF) for k in range(256)))
+            mask &= _column_mask(b3, _HAS_AF)
+            mask &= _column_mask(b4, _NONZERO)
+            mask &= _column_mask(b5, _PCR_FLAG)
+            mask = mask.to_bytes(len(b1), 'big')
+
+            idx = mask.find(1)
+            while idx >= 0:
+                off = idx*size_pck + hdr_len + 6
+                #PCR base on 33 bits, 6 reserved bits, extension on 9 bits.
+                pcr = int.from_bytes(mv[off:off+6], 'big')
+                indices.append(idx)
+                pcrs.append((pcr >> 15)*300 + (pcr & 0x1FF))
+                idx = mask.find(1, idx + 1)
+        return indices, pcrs
+
+    def _file_writer_packets(self, packets: Iterable[TSPacket], mode: str) -> None:
         assert mode in ['ab', 'wb']
-        with open(self._fp, mode) as f:
-            #Do not use b''.join, as that would duplicate the file in memory.
+        #Do not use b''.join, as that would duplicate the file in memory.
+        if not hasattr(os, 'writev'):
+            #Buffered writer, a raw file may write packets partially.
+            with open(self._fp, mode) as f:
+                for packet in packets:
+                    f.write(bytes(packet))
+            return
+        with open(self._fp, mode, buffering=0) as f:
+            fd = f.fileno()
+            iovec = []
             for packet in packets:
-                f.write(bytes(packet))
+                iovec += packet._buffers()
+                if len(iovec) > _IOV_MAX - 2:
+                    _writev(fd, iovec)
+                    iovec.clear()
+            if iovec:
+                _writev(fd, iovec)
 
     def append_packet(self, packet: TSPacket) -> None:
         self._file_writer_packets([packet], 'ab')
 
-    def append_packets(self, packets: list[TSPacket]) -> None:
+    def append_packets(self, packets: Iterable[TSPacket]) -> None:
         self._file_writer_packets(packets, 'ab')
 
     def write_packet(self, packet: TSPacket) -> None:
         self._file_writer_packets([packet], 'wb')
 
-    def write_packets(self, packets: list[TSPacket]) -> None:
+    def write_packets(self, packets: Iterable[TSPacket]) -> None:
         self._file_writer_packets(packets, 'wb')
 
     def __iter__(self):
@@ -106,24 +291,40 @@ class ArbitraryTransportStream(AbstractTransportStream):
         assert self._pck_cls is not None
         yield from super().gen_packets()
 
-    def identify(self) -> tuple[Type[TSPacket], int]:
+    def gen_payloads(self) -> Generator[tuple[int, bool, Optional[bytes]], None, None]:
+        assert self._pck_cls is not None
+        yield from super().gen_payloads()
+
+    def packet_headers(self) -> PacketHeaders:
+        assert self._pck_cls is not None
+        return super().packet_headers()
+
+    def pcr_table(self, pid: int) -> tuple[array, array]:
+        assert self._pck_cls is not None
+        return super().pcr_table(pid)
+
+    def identify(self) -> int:
         assert self._fp.exists()
         with open(self._fp, 'rb') as f:
             buffer = f.read(16384)
+
+        #Fast path for files starting on a TS or M2TS packet boundary.
+        if buffer[0:1] == buffer[188:189] == buffer[376:377] == buffer[564:565] == b'G':
+            return 0
+        if buffer[4:5] == buffer[196:197] == buffer[388:389] == buffer[580:581] == b'G':
+            return 4
+
         pck_overhead = buffer.find(b'G')
         assert pck_overhead >= 0, "Cannot find any sync byte in first kilobytes!"
 
         trials = 0
         while (trials := trials + 1) < 5:
             size_pck = 188 + pck_overhead
-            cnt = hit = 0
-            while (cnt := cnt + 1) < 4:
-                hit += ord(b'G') == buffer[pck_overhead + cnt*size_pck]
-            #aligned on sync bytes?
-            if hit == cnt - 1:
+            #aligned on sync bytes? The strided slice yields the first byte of four packets.
+            if buffer[pck_overhead:pck_overhead + 4*size_pck:size_pck] == b'GGGG':
                 break
-            else:
-                pck_overhead = 1 + pck_overhead + buffer[pck_overhead+1:].find(b'G')
+            pck_overhead = buffer.find(b'G', pck_overhead + 1)
+            assert pck_overhead >= 0, "Cannot find aligned sync bytes in first kilobytes!"
         assert trials < 5
         return pck_overhead
 
@@ -156,27 +357,56 @@ class PIDFilter:
         if self._filter(packet.PID):
             return packet
 
+    def filter_array(self, pids: Iterable[int]) -> bytes:
+        """
+        Returns a mask with 1 for each PID of the column that passes the filter.
+        The filter is evaluated once per distinct PID.
+        """
+        #Two passes are made over the PIDs, so an iterator is consumed only once here.
+        pids = array('H', pids)
+        kept = bytearray(0x2000)
+        for pid in set(pids):
+            kept[pid] = bool(self._filter(pid))
+        return bytes(map(kept.__getitem__, pids))
+
 class Packetizer:
     def __init__(self, max_size: int = 32 << 10) -> None:
         self._max_size = max_size
         assert self._max_size > 0
         self._buffer = bytearray()
 
+    def feed(self, tp: TSPacket) -> Optional[PESPacket]:
+        """
+        Accumulates the payload of a transport packet, returns the PES packet it completes, if any.
+        """
+        pes_pck = None
+        if tp.payload_unit_start_indicator and self._buffer:
+            #Hand the accumulated payload over to the PES packet rather than copying it.
+            pes_pck = PESPacket(self._buffer)
+            self._buffer = bytearray()
+        self._buffer += tp.payload
+        assert len(self._buffer) < self._max_size
+        return pes_pck
+
+    def flush(self) -> Optional[PESPacket]:
+        """
+        Returns the pending PES packet at the end of the stream, if it is a valid one.
+        """
+        if len(self._buffer) == 0:
+            return None
+        pes_buf, self._buffer = self._buffer, bytearray()
+        try:
+            return PESPacket(pes_buf)
+        except Exception:
+            return None
+
     def packetize(self) -> Generator[Optional[PESPacket], None, None]:
+        #Coroutine interface, feed() and flush() avoid the send() overhead.
         tp = yield
         while tp is not None:
-            pes_pck = None
-            if tp.payload_unit_start_indicator:
-                pes_pck = PESPacket(bytes(self._buffer))
-                self._buffer.clear()
-            self._buffer += tp.payload
-            assert len(self._buffer) < self._max_size
-            tp = yield pes_pck
+            tp = yield self.feed(tp)
         ####
-        if len(self._buffer) > 0:
-            try:
-                yield PESPacket(self._buffer)
-            except:
-                ...
+        if (pes_pck := self.flush()) is not None:
+            yield pes_pck
         return
     ####
@@ -23,30 +23,31 @@ import struct
 from generics import *
 from consts import AdaptationFieldControl
 
+_U32_BE = struct.Struct(">I")
+
 class ProgramClockReference(OptionalBlock):
     def size(self) -> int:
         return 6
 
     @property
     def base(self) -> int:
-        return struct.unpack(">I", self.data[:4])[0] << 1 | (self.data[4] >> 7)
+        return _U32_BE.unpack_from(self.data, 0)[0] << 1 | (self.data[4] >> 7)
 
     @property
     def extension(self) -> int:
         return ((self.data[4] & 0x01) << 8) | self.data[5]
 
     def to_pcr(self) -> int:
-        return self.extension + (self.base * 300)
+        #base (33 bits), reserved (6 bits), extension (9 bits) from a single 48-bit load.
+        pcr = int.from_bytes(self.data[:6], 'big')
+        return (pcr >> 15)*300 + (pcr & 0x1FF)
 
     @classmethod
     def from_stc(cls, stc: int) -> 'ProgramClockReference':
-        base = (stc/300) & ((1 << 33) - 1)
+        base = (stc // 300) & ((1 << 33) - 1)
         extension = stc % 300
-        ba = bytearray(b'\x00'*6)
-        ba[:5] = struct.pack(">Q", base << 7)[3:]
-        ba[5] = extension & 0xFF
-        ba[4] |= (ba >> 8) & 0x01
-        return ba
+        #base (33 bits), reserved (6 bits, all set), extension (9 bits)
+        return cls(((base << 15) | 0x7E00 | extension).to_bytes(6, 'big'))
 
 class TransportPrivateData(OptionalBlock):
     def size(self) -> int:
@@ -66,6 +67,28 @@ class AdaptationFieldExtension(OptionalBlock):
 
 #%%
 class AdaptationField(OptionalBlock):
+    __slots__ = ('_offset_opcr', '_offset_splice_countdown', '_offset_tprivdat', '_offset_afe', '_offset_stuffing')
+    def __init__(self, data: bytes) -> None:
+        super().__init__(data)
+        self._layout()
+
+    def _layout(self) -> None:
+        #Walk the flags once, each offset is the start of the optional field.
+        #An empty adaptation field has no flags byte.
+        flags = self.data[1] if len(self.data) > 1 else 0
+        offset = min(2, len(self.data)) + 6*((flags >> 4) & 0x01)
+        self._offset_opcr = offset
+        offset += 6*((flags >> 3) & 0x01)
+        self._offset_splice_countdown = offset
+        offset += (flags >> 2) & 0x01
+        self._offset_tprivdat = offset
+        if flags & 0x02:
+            offset += self.data[offset] + 1
+        self._offset_afe = offset
+        if flags & 0x01:
+            offset += self.data[offset] + 1
+        self._offset_stuffing = offset
+
     def size(self) -> int:
         return self.length + 1
 
@@ -93,76 +116,62 @@ class AdaptationField(OptionalBlock):
     def adaptation_field_extension_flag(self) -> bool:
         return (self.data[1] & 0x01) > 0
 
-    def _offset_pcr(self) -> int:
-        return 2
-
-    def _offset_opcr(self) -> int:
-        return 6*self.PCR_flag + self._offset_pcr()
-
-    def _offset_splice_countdown(self) -> int:
-        return 6*self.OPCR_flag + self._offset_opcr()
-
-    def _offset_tprivdat(self) -> int:
-        return 1*self.splicing_point_flag + self._offset_splice_countdown()
-
     @property
     @exist_if(PCR_flag)
     def program_clock_reference(self) -> ProgramClockReference:
-        return ProgramClockReference(self.data[self._offset_pcr():])
+        return ProgramClockReference(self.data[2:])
 
     @property
     @exist_if(OPCR_flag)
     def original_program_clock_reference(self) -> ProgramClockReference:
-        return ProgramClockReference(self.data[self._offset_opcr():])
+        return ProgramClockReference(self.data[self._offset_opcr:])
 
     @property
     @exist_if(splicing_point_flag)
     def splice_countdown(self) -> int:
-        return self.data[self._offset_splice_countdown()]
+        return self.data[self._offset_splice_countdown]
 
     @property
     @exist_if(transport_private_data_flag)
     def transport_private_data(self) -> TransportPrivateData:
-        return TransportPrivateData(self.data[self._offset_tprivdat():])
-
-    def _offset_afe(self) -> int:
-        return self._offset_tprivdat() + (len(self.transport_private_data) if self.transport_private_data_flag else 0)
+        return TransportPrivateData(self.data[self._offset_tprivdat:])
 
     @property
     @exist_if(adaptation_field_extension_flag)
     def adaptation_field_extension(self) -> AdaptationFieldExtension:
-        return AdaptationFieldExtension(self.data[self._offset_afe():])
-
-    def _offset_stuffing(self) -> int:
-        return self._offset_afe() + (len(self.adaptation_field_extension) if self.adaptation_field_extension_flag else 0)
+        return AdaptationFieldExtension(self.data[self._offset_afe:])
 
     @property
     def stuffing(self) -> bytes:
-        off_stuff = self._offset_stuffing()
-        len_stuff = self.length - off_stuff
+        off_stuff = self._offset_stuffing
+        #adaptation_field_length does not count itself.
+        len_stuff = self.length + 1 - off_stuff
         assert len_stuff >= 0
-        assert not any(filter(lambda x: x != 0xFF, self.data[off_stuff:off_stuff+len_stuff]))
-        return self.data[off_stuff:off_stuff+len_stuff]
+        stuffing = self.data[off_stuff:off_stuff+len_stuff]
+        assert bytes(stuffing).count(0xFF) == len_stuff
+        return stuffing
 ####
 
 #%%
 class TSPacket:
     __slots__ = ("data")
-    @classproperty
-    def size(cls) -> int:
-        return 188
-
-    @classproperty
-    def header_len(cls) -> int:
-        return 0
+    size = 188
+    header_len = 0
 
     def __init__(self, data: bytes) -> None:
-        assert len(data) >= __class__.size
-        self.data = data[:__class__.size]
-        assert self.sync_byte == ord(b'G')
+        size = __class__.size
+        assert len(data) >= size
+        #Own the bytes: a view may be on a buffer that is reused or unmapped later.
+        #bytes of exactly the packet size are taken as-is, without a copy.
+        self.data = bytes(data[:size])
+        assert data[0] == 0x47
 
     def __bytes__(self) -> bytes:
-        return self.data
+        return bytes(self.data)
+
+    def _buffers(self) -> tuple[bytes, ...]:
+        #Buffers making up the packet on disk, for scatter-gather writes.
+        return (self.data,)
 
     def __str__(self) -> str:
         return f"{self.PID:04X} {self.continuity_counter:1X}: PUSI={self.payload_unit_start_indicator:1} AFC={self.adaptation_field_control:1}"
@@ -199,57 +208,63 @@ class TSPacket:
 
     @property
     def adaptation_field_control(self) -> int:
-        return AdaptationFieldControl((self.data[3] >> 4) & 0b11)
+        afc = (self.data[3] >> 4) & 0b11
+        assert afc > 0, "Illegal adaptation_field_control"
+        return AdaptationFieldControl(afc)
 
     @property
     def continuity_counter(self) -> int:
         return self.data[3] & 0xF
 
+    #adaptation_field and payload test the raw AFC bits to not build an enum per access.
     @property
-    @exist_if(adaptation_field_control, lambda afc: AdaptationFieldControl.ADAPTATION in afc)
-    def adaptation_field(self) -> AdaptationField:
-        return AdaptationField(self.data[4:])
+    def adaptation_field(self) -> Optional[AdaptationField]:
+        afc = self.data[3] & 0x30
+        assert afc, "Illegal adaptation_field_control"
+        if afc & 0x20: #ADAPTATION
+            return AdaptationField(self.data[4:])
+        return None
 
     @property
-    @exist_if(adaptation_field_control, lambda afc: AdaptationFieldControl.PAYLOAD in afc)
-    def payload(self) -> bytes:
-        offset = 0 if self.adaptation_field is None else self.adaptation_field.size()
-        return self.data[4 + offset:]
+    def payload(self) -> Optional[bytes]:
+        afc = self.data[3] & 0x30
+        assert afc, "Illegal adaptation_field_control"
+        if not afc & 0x10: #PAYLOAD
+            return None
+        if afc & 0x20:
+            #Skip adaptation_field_length and the adaptation field.
+            return self.data[5 + self.data[4]:]
+        return self.data[4:]
 ####
 
 #%%
 class M2TSPacket(TSPacket):
     __slots__ = ('tp_extra_header')
-
-    @classproperty
-    def size(cls) -> int:
-        return 192
-
-    @classproperty
-    def header_len(cls) -> int:
-        return 4
+    size = 192
+    header_len = 4
 
     def __init__(self, data: bytes):
         assert len(data) >= __class__.size
         super().__init__(data[4:__class__.size])
-        self.tp_extra_header = data[:4]
+        self.tp_extra_header = bytearray(data[:4])
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.tp_extra_header) + bytes(self.data)
+
+    def _buffers(self) -> tuple[bytes, ...]:
+        return (self.tp_extra_header, self.data)
 
     def to_tspacket(self) -> TSPacket:
         return TSPacket(self.data)
 
     @property
     def arrival_time_stamp(self) -> int:
-        atc = self.tp_extra_header[0] & 0x3F
-        for k in range(1, 4):
-            atc = (atc << 8) + self.tp_extra_header[k]
-        return atc
+        return _U32_BE.unpack_from(self.tp_extra_header, 0)[0] & 0x3FFFFFFF
 
     @arrival_time_stamp.setter
     def arrival_time_stamp(self, atc: int) -> None:
-        self.tp_extra_header[0] = (self.tp_extra_header[0] & 0xC0) | ((atc >> 24) & 0x3F)
-
-        for k in range(1, 4):
-            self.tp_extra_header[k] = (atc >> (24 - k*8)) & 0xFF
+        cpi = self.tp_extra_header[0] & 0xC0
+        _U32_BE.pack_into(self.tp_extra_header, 0, (cpi << 24) | (atc & 0x3FFFFFFF))
 
     @property
     def copy_permission_indicator(self) -> int: